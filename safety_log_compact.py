@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Safety Log Compaction Script
+Exports the JSON Lines safety log (metrics/safety_log.jsonl) as a single
+JSON array (metrics/safety_log.json) for tools that expect the legacy format
+"""
+
+import sys
+from pathlib import Path
+
+# Add parent directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from src.safety import compact_safety_log
+
+
+def main():
+    """Main compaction entry point."""
+    count = compact_safety_log()
+    print(f"Wrote {count} safety log entries to metrics/safety_log.json")
+
+
+if __name__ == "__main__":
+    main()
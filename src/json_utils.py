@@ -0,0 +1,111 @@
+"""
+JSON Helpers for Multi-Task Text Utility
+Uses orjson when it is installed and falls back to the standard library
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Iterator, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# orjson.JSONDecodeError subclasses this, so callers can catch either parser's errors
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Parse a JSON document from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """
+    Serialize an object to UTF-8 encoded JSON.
+    
+    Args:
+        obj: The object to serialize
+        indent: Pretty-print with two-space indentation
+        
+    Returns:
+        The JSON document as bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def dumps_line(obj: Any) -> bytes:
+    """Serialize an object as one newline-terminated JSON Lines record."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return dumps(obj) + b"\n"
+
+
+def iter_jsonl(path: Union[str, Path]) -> Iterator[Any]:
+    """Stream the records of a JSON Lines file; a missing file yields nothing."""
+    path = Path(path)
+    if not path.exists():
+        return
+    
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def iter_json_array(path: Union[str, Path]) -> Iterator[Any]:
+    """
+    Stream the items of a JSON array file; a missing file yields nothing.
+    
+    With ijson installed the array is parsed incrementally, so memory stays
+    flat however large the file is; otherwise the whole file is loaded.
+    
+    Args:
+        path: JSON array file to read
+        
+    Yields:
+        One array item at a time
+    """
+    path = Path(path)
+    if not path.exists():
+        return
+    
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, "item", use_float=True)
+        else:
+            yield from loads(f.read())
+
+
+def compact_jsonl(jsonl_path: Union[str, Path], json_path: Union[str, Path]) -> int:
+    """
+    Write a JSON Lines file out as a single JSON array, one record at a time.
+    
+    Args:
+        jsonl_path: JSON Lines file to read
+        json_path: JSON array file to write
+        
+    Returns:
+        Number of records written
+    """
+    count = 0
+    with open(json_path, 'wb') as f:
+        f.write(b"[")
+        for record in iter_jsonl(jsonl_path):
+            f.write(b",\n  " if count else b"\n  ")
+            f.write(dumps(record))
+            count += 1
+        f.write(b"\n]\n" if count else b"]\n")
+    return count
@@ -5,15 +5,78 @@ Processes user questions using OpenAI API with prompt engineering techniques
 """
 
 import os
+import csv
+import mmap
 import json
 import time
+import asyncio
+import functools
+import contextlib
+import importlib.util
+import hashlib
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Any, Optional
-from openai import OpenAI
+from typing import Callable, Dict, Any, Iterator, List, Optional
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from openai.types import CompletionUsage
 from pathlib import Path
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 # Import safety module
 from src.safety import SafetyChecker
+from src.semantic_cache import SemanticCache
+from src import json_utils
+from src import schemas
+
+METRICS_DIR = Path(__file__).parent.parent / "metrics"
+PROMPT_TEMPLATE_PATH = Path(__file__).parent.parent / "prompts" / "main_prompt.txt"
+
+# HTTP/2 multiplexes concurrent requests over one connection; httpx needs h2 for it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+@functools.lru_cache(maxsize=4)
+def _encoder(model: str):
+    """Return the (cached) tiktoken encoding for a model, or None without tiktoken."""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Unknown or provider-prefixed model names
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # BPE tables are downloaded on first use; token counting is best-effort
+        return None
+
+
+def compile_template(template: str, placeholder: str = "{question}") -> Callable[[str], str]:
+    """
+    Pre-split a prompt template into a function that fills in the question.
+    
+    Args:
+        template: Template text containing the placeholder
+        placeholder: Marker replaced by the question
+        
+    Returns:
+        Function mapping a question to the full prompt
+        
+    Raises:
+        ValueError: If the template has no placeholder
+    """
+    parts = template.split(placeholder)
+    if len(parts) == 1:
+        raise ValueError(f"Prompt template is missing the {placeholder} placeholder")
+    
+    if len(parts) == 2:
+        prefix, suffix = parts
+        return lambda question: prefix + question + suffix
+    return lambda question: question.join(parts)
 
 
 class TextUtility:
@@ -22,18 +85,60 @@ class TextUtility:
     Implements few-shot learning and chain-of-thought prompting techniques.
     """
     
-    def __init__(self, api_key: Optional[str] = None):
-        """Initialize the text utility with OpenAI client."""
+    # Column order of the metrics CSV log
+    METRICS_FIELDNAMES = (
+        "timestamp", "tokens_prompt", "tokens_completion", "total_tokens",
+        "latency_ms", "estimated_cost", "model", "question_preview"
+    )
+    
+    # System message sent ahead of every prompt
+    SYSTEM_MESSAGE = "You are a helpful AI assistant that provides structured, accurate responses."
+    
+    # Chat framing tokens per message (on top of its role and content) and for
+    # priming the assistant's reply, as in OpenAI's token counting guide
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_REPLY_PRIMING = 3
+    
+    # Batch API jobs are billed at half the online price
+    BATCH_PRICE_FACTOR = 0.5
+    BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+    
+    def __init__(self, api_key: Optional[str] = None, cache_size: int = 1024,
+                 cache_ttl: float = 3600, semantic_cache: bool = False,
+                 max_prompt_tokens: Optional[int] = None):
+        """
+        Initialize the text utility with OpenAI client.
+        
+        Args:
+            api_key: OpenAI API key (defaults to OPENAI_API_KEY)
+            cache_size: Maximum number of cached responses (0 disables caching)
+            cache_ttl: Seconds a cached response stays valid
+            semantic_cache: Also reuse answers for near-duplicate questions
+                (requires faiss-cpu and numpy; capped at cache_size entries)
+            max_prompt_tokens: Reject prompts estimated above this many tokens
+                before calling the API (requires tiktoken; None disables)
+        """
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Set OPENAI_API_KEY environment variable.")
         
-        self.client = OpenAI(api_key=self.api_key)
         self.model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
-        self.safety_checker = SafetyChecker(self.client)
+        self.max_prompt_tokens = max_prompt_tokens
+        
+        # Exact-match response cache: key -> (result, expires_at), in LRU order
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self.semantic_cache = (SemanticCache(self.client, ttl=cache_ttl, max_entries=cache_size)
+                               if semantic_cache else None)
         
-        # Load prompt template
-        self.prompt_template = self._load_prompt_template()
+        # Metrics log handles, opened on first use and kept open across queries
+        self._csv_fh = None
+        self._csv_writer = None
+        self._jsonl_fh = None
+        
+        # process_queries calls in flight; the last one to finish closes the async client
+        self._async_calls = 0
         
         # Pricing per 1K tokens (as of 2024, adjust as needed)
         self.pricing = {
@@ -42,14 +147,144 @@ class TextUtility:
             "gpt-4-turbo": {"prompt": 0.01, "completion": 0.03},
         }
     
+    # Clients, the safety checker and the prompt template are built on first
+    # use, so constructing a TextUtility stays cheap
+    
+    @functools.cached_property
+    def client(self) -> OpenAI:
+        """Synchronous OpenAI client (pooled keep-alive connections, HTTP/2 if available)."""
+        http_client = DefaultHttpxClient(http2=True) if HTTP2_AVAILABLE else None
+        client = OpenAI(api_key=self.api_key, http_client=http_client)
+        # A client recreated after close() replaces the closed one everywhere
+        for component in (self.__dict__.get("safety_checker"), self.__dict__.get("semantic_cache")):
+            if component is not None:
+                component.client = client
+        return client
+    
+    @functools.cached_property
+    def async_client(self) -> AsyncOpenAI:
+        """Asynchronous OpenAI client (pooled keep-alive connections, HTTP/2 if available)."""
+        http_client = DefaultAsyncHttpxClient(http2=True) if HTTP2_AVAILABLE else None
+        async_client = AsyncOpenAI(api_key=self.api_key, http_client=http_client)
+        if "safety_checker" in self.__dict__:
+            self.safety_checker.async_client = async_client
+        return async_client
+    
+    async def _close_async_client(self):
+        """Close the async client, if created, so the next event loop gets a fresh pool."""
+        async_client = self.__dict__.pop("async_client", None)
+        if async_client is None:
+            return
+        if "safety_checker" in self.__dict__:
+            self.safety_checker.async_client = None
+        await async_client.close()
+    
+    @contextlib.asynccontextmanager
+    async def _async_client_scope(self):
+        """
+        Keep the async client open for the duration of an async call.
+        
+        The client's pool is bound to the running event loop, and asyncio.run
+        starts a new loop per call, so the outermost scope closes it on exit.
+        """
+        self._async_calls += 1
+        try:
+            yield self.async_client
+        finally:
+            self._async_calls -= 1
+            if not self._async_calls:
+                await self._close_async_client()
+    
+    def close(self):
+        """
+        Release the HTTP connection pools and close the metrics log.
+        
+        Both clients are dropped, so a later call creates fresh ones. Async calls
+        close their own client when they finish; from a running event loop, use
+        aclose() to close one that is still open.
+        """
+        client = self.__dict__.pop("client", None)
+        if client is not None:
+            client.close()
+        if self.semantic_cache is not None:
+            self.semantic_cache.close()
+        if "async_client" in self.__dict__ and not self._async_calls:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # No loop is running, so the client is shut down on a fresh one
+                asyncio.run(self._close_async_client())
+        if self._csv_fh is not None:
+            self._csv_fh.close()
+            self._csv_fh = None
+            self._csv_writer = None
+        if self._jsonl_fh is not None:
+            self._jsonl_fh.close()
+            self._jsonl_fh = None
+    
+    def __enter__(self) -> "TextUtility":
+        """Use the utility as a context manager that closes it on exit."""
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the client and metrics logs."""
+        self.close()
+    
+    async def __aenter__(self) -> "TextUtility":
+        """Use the utility as an async context manager that closes it on exit."""
+        # The async client then stays open across the calls made inside the block
+        self._async_calls += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Close both clients and the metrics logs."""
+        self._async_calls -= 1
+        await self.aclose()
+    
+    async def aclose(self):
+        """Release the async client's connection pool and close the metrics log."""
+        await self._close_async_client()
+        self.close()
+    
+    @functools.cached_property
+    def safety_checker(self) -> SafetyChecker:
+        """Safety checker sharing this utility's clients."""
+        # The async client is handed over when it is created, not forced into existence here
+        return SafetyChecker(self.client, self.__dict__.get("async_client"))
+    
+    @functools.cached_property
+    def prompt_template(self) -> str:
+        """The prompt template text."""
+        return self._load_prompt_template()
+    
+    @functools.cached_property
+    def _template_hash(self) -> str:
+        """SHA-256 of the prompt template, part of every cache key."""
+        return hashlib.sha256(self.prompt_template.encode("utf-8")).hexdigest()
+    
+    @functools.cached_property
+    def _format_prompt(self) -> Callable[[str], str]:
+        """The template compiled into a question -> prompt function."""
+        # Split once so each prompt is just two concatenations
+        return compile_template(self.prompt_template)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def _load_prompt(path: str) -> str:
+        """Read a prompt file; cached per path for every TextUtility in the process."""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            # Decode straight from the page cache instead of through a text buffer
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return str(mm, 'utf-8')
+    
     def _load_prompt_template(self) -> str:
         """Load the prompt template from file."""
-        template_path = Path(__file__).parent.parent / "prompts" / "main_prompt.txt"
         try:
-            with open(template_path, 'r', encoding='utf-8') as f:
-                return f.read()
+            return self._load_prompt(str(PROMPT_TEMPLATE_PATH))
         except FileNotFoundError:
-            print(f"Warning: Prompt template not found at {template_path}")
+            print(f"Warning: Prompt template not found at {PROMPT_TEMPLATE_PATH}")
             return self._get_default_prompt()
     
     def _get_default_prompt(self) -> str:
@@ -66,17 +301,325 @@ Analyze the user's question and provide a comprehensive answer in the following
 
 User question: {question}"""
     
+    @functools.cached_property
+    def _template_tokens(self) -> Optional[int]:
+        """
+        Prompt tokens of a request apart from the question (needs tiktoken).
+        
+        Covers the system message, the template and the chat framing of both
+        messages, so the estimate is an upper bound rather than just the template.
+        """
+        encoder = _encoder(self.model)
+        if encoder is None:
+            return None
+        framing = (2 * self.TOKENS_PER_MESSAGE + self.TOKENS_REPLY_PRIMING
+                   + len(encoder.encode("system")) + len(encoder.encode("user")))
+        return (framing + len(encoder.encode(self.SYSTEM_MESSAGE))
+                + len(encoder.encode(self._format_prompt(""))))
+    
+    @property
+    def pricing(self) -> Dict[str, Dict[str, float]]:
+        """Prices per 1K tokens by model; assign a new dictionary to change them."""
+        return self._pricing
+    
+    @pricing.setter
+    def pricing(self, pricing: Dict[str, Dict[str, float]]):
+        self._pricing = pricing
+        self._rates_by_model: Dict[str, tuple] = {}
+    
+    def _token_rates(self, model: str) -> tuple:
+        """Per-token (prompt, completion) prices for a model, cached per model name."""
+        rates = self._rates_by_model.get(model)
+        if rates is None:
+            model_key = model
+            if model_key not in self.pricing:
+                # Default to gpt-3.5-turbo pricing for unknown models
+                model_key = "gpt-3.5-turbo"
+            
+            pricing = self.pricing[model_key]
+            rates = (pricing["prompt"] / 1000, pricing["completion"] / 1000)
+            self._rates_by_model[model] = rates
+        return rates
+    
     def _calculate_cost(self, prompt_tokens: int, completion_tokens: int) -> float:
         """Calculate the cost of the API call."""
-        model_key = self.model
-        if model_key not in self.pricing:
-            # Default to gpt-3.5-turbo pricing for unknown models
-            model_key = "gpt-3.5-turbo"
+        prompt_rate, completion_rate = self._token_rates(self.model)
+        return prompt_tokens * prompt_rate + completion_tokens * completion_rate
+    
+    @property
+    def _cache_namespace(self) -> str:
+        """Model and template identity; cached answers are only valid within it."""
+        return f"{self.model}|{self._template_hash}"
+    
+    def _cache_key(self, user_question: str) -> str:
+        """Build the cache key for a question under the current model and template."""
+        raw = f"{self._cache_namespace}|{user_question.strip().lower()}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached result for a key, dropping it if expired."""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        
+        result, expires_at = entry
+        if expires_at < time.time():
+            del self._cache[key]
+            return None
         
-        pricing = self.pricing[model_key]
-        prompt_cost = (prompt_tokens / 1000) * pricing["prompt"]
-        completion_cost = (completion_tokens / 1000) * pricing["completion"]
-        return prompt_cost + completion_cost
+        self._cache.move_to_end(key)
+        return result
+    
+    def _cache_put(self, key: str, result: Dict[str, Any]):
+        """Store a result in the cache, evicting least recently used entries."""
+        if self.cache_size <= 0:
+            return
+        
+        self._cache[key] = (result, time.time() + self.cache_ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    def _cached_response(self, cached: Dict[str, Any], source: str,
+                         start_time: float) -> Dict[str, Any]:
+        """Build the result for a cache hit; no tokens are spent."""
+        end_time = time.time()
+        return {
+            **cached,
+            "cached": source,
+            "timestamp": datetime.fromtimestamp(end_time).isoformat(),
+            "metrics": {
+                "tokens_prompt": 0,
+                "tokens_completion": 0,
+                "total_tokens": 0,
+                "latency_ms": int((end_time - start_time) * 1000),
+                "estimated_cost": 0.0
+            }
+        }
+    
+    def _rejected_result(self, safety_result: Dict[str, Any], start_time: float) -> Dict[str, Any]:
+        """Build the result for a question that failed the safety check."""
+        end_time = time.time()
+        return {
+            "status": "rejected",
+            "reason": "Safety check failed",
+            "safety_analysis": safety_result,
+            "timestamp": datetime.fromtimestamp(end_time).isoformat(),
+            "metrics": {
+                "tokens_prompt": 0,
+                "tokens_completion": 0,
+                "total_tokens": 0,
+                "latency_ms": int((end_time - start_time) * 1000),
+                "estimated_cost": 0.0
+            }
+        }
+    
+    def _estimate_prompt_tokens(self, user_question: str, suffix: str = "") -> Optional[int]:
+        """
+        Estimate the prompt's token count locally, or None without tiktoken.
+        
+        Args:
+            user_question: The text substituted into the template
+            suffix: Text appended to the user message after the template
+        """
+        encoder = _encoder(self.model)
+        if encoder is None:
+            return None
+        # The template's share is counted once; only the question is encoded
+        tokens = self._template_tokens + len(encoder.encode(user_question))
+        if suffix:
+            tokens += len(encoder.encode(suffix))
+        return tokens
+    
+    def _estimate_usage(self, user_question: str, response_content: str,
+                        suffix: str = "") -> Optional[CompletionUsage]:
+        """Estimate token usage locally with the cached encoder, or None without tiktoken."""
+        encoder = _encoder(self.model)
+        prompt_tokens = self._estimate_prompt_tokens(user_question, suffix)
+        if encoder is None or prompt_tokens is None:
+            return None
+        completion_tokens = len(encoder.encode(response_content))
+        return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                               total_tokens=prompt_tokens + completion_tokens)
+    
+    def _over_budget_result(self, user_question: str, start_time: float,
+                            suffix: str = "") -> Optional[Dict[str, Any]]:
+        """Build a rejection if the prompt would exceed max_prompt_tokens, else None."""
+        if self.max_prompt_tokens is None:
+            return None
+        
+        estimated_tokens = self._estimate_prompt_tokens(user_question, suffix)
+        if estimated_tokens is None or estimated_tokens <= self.max_prompt_tokens:
+            return None
+        
+        end_time = time.time()
+        return {
+            "status": "rejected",
+            "reason": "Prompt exceeds token budget",
+            "estimated_prompt_tokens": estimated_tokens,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "timestamp": datetime.fromtimestamp(end_time).isoformat(),
+            "metrics": {
+                "tokens_prompt": 0,
+                "tokens_completion": 0,
+                "total_tokens": 0,
+                "latency_ms": int((end_time - start_time) * 1000),
+                "estimated_cost": 0.0
+            }
+        }
+    
+    def _error_result(self, error: Exception) -> Dict[str, Any]:
+        """Build the result for a failed API call or unparseable response."""
+        if isinstance(error, json_utils.JSONDecodeError):
+            message = f"Failed to parse JSON response: {str(error)}"
+        elif isinstance(error, schemas.ValidationError):
+            message = f"Response does not match the expected schema: {str(error)}"
+        else:
+            message = str(error)
+        return {
+            "status": "error",
+            "error": message,
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    def _lookup_caches(self, user_question: str, cache_key: str, start_time: float):
+        """
+        Look a question up in the exact and semantic caches.
+        
+        Returns:
+            Tuple of (cache hit result or None, question embedding or None)
+        """
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return self._cached_response(cached, "exact", start_time), None
+        
+        if self.semantic_cache is None:
+            return None, None
+        question_vector = self._embed_question(user_question)
+        return self._semantic_lookup(user_question, cache_key, question_vector, start_time)
+    
+    def _embed_question(self, user_question: str):
+        """Embed a question for the semantic cache; errors only skip the cache."""
+        try:
+            return self.semantic_cache.embed(user_question)
+        except Exception:
+            return None
+    
+    def _semantic_lookup(self, user_question: str, cache_key: str, question_vector,
+                         start_time: float):
+        """
+        Fall back to near-duplicate questions in the semantic cache.
+        
+        Returns:
+            Tuple of (cache hit result or None, question embedding or None)
+        """
+        if question_vector is None:
+            return None, None
+        try:
+            cached = self.semantic_cache.lookup(user_question, question_vector,
+                                                self._cache_namespace)
+        except Exception:
+            return None, None
+        if cached is not None:
+            self._cache_put(cache_key, cached)
+            return self._cached_response(cached, "semantic", start_time), question_vector
+        return None, question_vector
+    
+    def _completion_request(self, user_question: str) -> Dict[str, Any]:
+        """Build the chat completion arguments for a question."""
+        # Prepare the prompt with few-shot examples
+        prompt = self._format_prompt(user_question)
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": self.SYSTEM_MESSAGE},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.7,
+            "response_format": {"type": "json_object"},
+            # Stream the answer; usage arrives on the final chunk
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+    
+    @staticmethod
+    def _read_chunk(chunk, parts: List[str]):
+        """Collect a streamed chunk's content into parts and return its usage, if any."""
+        if chunk.choices:
+            parts.append(chunk.choices[0].delta.content or "")
+        return chunk.usage
+    
+    def _finish_query(self, response_content: str, usage, user_question: str, cache_key: str,
+                      question_vector, start_time: float,
+                      price_factor: float = 1.0) -> Dict[str, Any]:
+        """Turn a completed answer into the result dictionary, then log and cache it."""
+        if usage is None:
+            # The stream ended without a usage chunk; count locally instead
+            usage = self._estimate_usage(user_question, response_content)
+        
+        # Parse and validate response
+        try:
+            parsed_response = schemas.validate_response(json_utils.loads(response_content))
+        except (json_utils.JSONDecodeError, schemas.ValidationError) as e:
+            return self._invalid_result(e, usage, user_question, start_time, price_factor)
+        return self._success_result(parsed_response, usage, user_question, cache_key,
+                                    question_vector, start_time, price_factor)
+    
+    def _usage_metrics(self, usage, start_time: float, price_factor: float = 1.0):
+        """
+        Calculate the metrics for a completed call.
+        
+        Returns:
+            Tuple of (metrics dictionary, ISO timestamp)
+        """
+        # One clock read serves latency and timestamp
+        end_time = time.time()
+        latency_ms = int((end_time - start_time) * 1000)
+        timestamp = datetime.fromtimestamp(end_time).isoformat()
+        
+        prompt_tokens = usage.prompt_tokens if usage else 0
+        completion_tokens = usage.completion_tokens if usage else 0
+        total_tokens = usage.total_tokens if usage else 0
+        estimated_cost = self._calculate_cost(prompt_tokens, completion_tokens) * price_factor
+        
+        metrics = {
+            "tokens_prompt": prompt_tokens,
+            "tokens_completion": completion_tokens,
+            "total_tokens": total_tokens,
+            "latency_ms": latency_ms,
+            "estimated_cost": round(estimated_cost, 6)
+        }
+        return metrics, timestamp
+    
+    def _invalid_result(self, error: Exception, usage, user_question: str, start_time: float,
+                        price_factor: float = 1.0) -> Dict[str, Any]:
+        """Build the error result for an unusable answer, logging the tokens it still cost."""
+        metrics, timestamp = self._usage_metrics(usage, start_time, price_factor)
+        self._log_metrics(metrics, user_question, timestamp)
+        return {**self._error_result(error), "timestamp": timestamp, "metrics": metrics}
+    
+    def _success_result(self, parsed_response: Dict[str, Any], usage, user_question: str,
+                        cache_key: str, question_vector, start_time: float,
+                        price_factor: float = 1.0) -> Dict[str, Any]:
+        """Build the result for a validated answer, then log and cache it."""
+        metrics, timestamp = self._usage_metrics(usage, start_time, price_factor)
+        
+        # Construct result
+        result = {
+            "status": "success",
+            "response": parsed_response,
+            "timestamp": timestamp,
+            "model": self.model,
+            "metrics": metrics
+        }
+        
+        # Log metrics
+        self._log_metrics(metrics, user_question, timestamp)
+        self._cache_put(cache_key, result)
+        if question_vector is not None:
+            self.semantic_cache.add(user_question, question_vector, result, self._cache_namespace)
+        
+        return result
     
     def process_query(self, user_question: str, check_safety: bool = True) -> Dict[str, Any]:
         """
@@ -95,121 +638,483 @@ User question: {question}"""
         if check_safety:
             safety_result = self.safety_checker.check_prompt(user_question)
             if not safety_result["is_safe"]:
-                return {
-                    "status": "rejected",
-                    "reason": "Safety check failed",
-                    "safety_analysis": safety_result,
-                    "timestamp": datetime.now().isoformat(),
-                    "metrics": {
-                        "tokens_prompt": 0,
-                        "tokens_completion": 0,
-                        "total_tokens": 0,
-                        "latency_ms": int((time.time() - start_time) * 1000),
-                        "estimated_cost": 0.0
-                    }
-                }
+                return self._rejected_result(safety_result, start_time)
         
-        # Prepare the prompt with few-shot examples
-        prompt = self.prompt_template.replace("{question}", user_question)
+        # Serve repeated questions from the cache without an API call
+        cache_key = self._cache_key(user_question)
+        cached, question_vector = self._lookup_caches(user_question, cache_key, start_time)
+        if cached is not None:
+            return cached
+        
+        # Pre-flight budget check: pure CPU, no round trip
+        over_budget = self._over_budget_result(user_question, start_time)
+        if over_budget is not None:
+            return over_budget
         
         try:
-            # Make API call
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful AI assistant that provides structured, accurate responses."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                response_format={"type": "json_object"}
-            )
+            # Make API call and assemble the streamed answer
+            stream = self.client.chat.completions.create(**self._completion_request(user_question))
+            parts: List[str] = []
+            usage = None
+            for chunk in stream:
+                usage = self._read_chunk(chunk, parts) or usage
+            return self._finish_query("".join(parts), usage, user_question, cache_key,
+                                      question_vector, start_time)
+        except Exception as e:
+            return self._error_result(e)
+    
+    async def aprocess_query(self, user_question: str, check_safety: bool = True) -> Dict[str, Any]:
+        """
+        Async variant of process_query using the AsyncOpenAI client.
+        
+        Args:
+            user_question: The user's question
+            check_safety: Whether to check for adversarial prompts
             
-            # Calculate metrics
-            end_time = time.time()
-            latency_ms = int((end_time - start_time) * 1000)
+        Returns:
+            Dictionary containing response and metrics
+        """
+        async with self._async_client_scope():
+            return await self._aprocess_query(user_question, check_safety)
+    
+    async def _aprocess_query(self, user_question: str, check_safety: bool) -> Dict[str, Any]:
+        """aprocess_query's body, run while the async client is held open."""
+        start_time = time.time()
+        
+        # Safety check
+        if check_safety:
+            safety_result = await self.safety_checker.check_prompt_async(user_question)
+            if not safety_result["is_safe"]:
+                return self._rejected_result(safety_result, start_time)
+        
+        # Serve repeated questions from the cache. Only the embedding request runs in a
+        # worker thread; the LRU dict and the FAISS index are only touched on the loop
+        cache_key = self._cache_key(user_question)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return self._cached_response(cached, "exact", start_time)
+        question_vector = None
+        if self.semantic_cache is not None:
+            question_vector = await asyncio.to_thread(self._embed_question, user_question)
+            cached, question_vector = self._semantic_lookup(
+                user_question, cache_key, question_vector, start_time
+            )
+            if cached is not None:
+                return cached
+        
+        # Pre-flight budget check: pure CPU, no round trip
+        over_budget = self._over_budget_result(user_question, start_time)
+        if over_budget is not None:
+            return over_budget
+        
+        try:
+            # Make API call and assemble the streamed answer
+            stream = await self.async_client.chat.completions.create(
+                **self._completion_request(user_question)
+            )
+            parts: List[str] = []
+            usage = None
+            async for chunk in stream:
+                usage = self._read_chunk(chunk, parts) or usage
+            return self._finish_query("".join(parts), usage, user_question, cache_key,
+                                      question_vector, start_time)
+        except Exception as e:
+            return self._error_result(e)
+    
+    async def process_queries(self, questions: List[str], check_safety: bool = True,
+                              max_concurrency: int = 8) -> List[Dict[str, Any]]:
+        """
+        Process several questions concurrently.
+        
+        Args:
+            questions: The user's questions
+            check_safety: Whether to check for adversarial prompts
+            max_concurrency: Maximum number of requests in flight at once
             
-            prompt_tokens = response.usage.prompt_tokens
-            completion_tokens = response.usage.completion_tokens
-            total_tokens = response.usage.total_tokens
-            estimated_cost = self._calculate_cost(prompt_tokens, completion_tokens)
+        Returns:
+            One result dictionary per question, in the same order
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def run_one(question: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.aprocess_query(question, check_safety)
+        
+        # One client (and pool) serves every question; it is closed when the last finishes
+        async with self._async_client_scope():
+            return await asyncio.gather(*(run_one(q) for q in questions))
+    
+    def _preflight_many(self, questions: List[str], check_safety: bool, start_time: float):
+        """
+        Run the safety, cache and budget checks for several questions.
+        
+        Returns:
+            Tuple of (results list with None for questions still needing an
+            answer, list of (index, question, cache key, embedding) to send)
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(questions)
+        to_send = []
+        
+        # One moderation request covers every question instead of a round trip each
+        if check_safety:
+            safety_results = self.safety_checker.check_prompts(questions)
+        else:
+            safety_results = [None] * len(questions)
+        
+        misses = []
+        for i, (user_question, safety_result) in enumerate(zip(questions, safety_results)):
+            if safety_result is not None and not safety_result["is_safe"]:
+                results[i] = self._rejected_result(safety_result, start_time)
+                continue
             
-            # Parse response
-            response_content = response.choices[0].message.content
-            parsed_response = json.loads(response_content)
+            cache_key = self._cache_key(user_question)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                results[i] = self._cached_response(cached, "exact", start_time)
+                continue
+            misses.append((i, user_question, cache_key))
+        
+        # Likewise, the exact-cache misses are embedded together
+        question_vectors = [None] * len(misses)
+        if self.semantic_cache is not None and misses:
+            try:
+                question_vectors = self.semantic_cache.embed_many([item[1] for item in misses])
+            except Exception:
+                pass
+        
+        for (i, user_question, cache_key), question_vector in zip(misses, question_vectors):
+            cached = None
+            if self.semantic_cache is not None:
+                cached, question_vector = self._semantic_lookup(user_question, cache_key,
+                                                                question_vector, start_time)
+            if cached is None:
+                cached = self._over_budget_result(user_question, start_time)
+            if cached is not None:
+                results[i] = cached
+                continue
             
-            # Construct result
-            result = {
-                "status": "success",
-                "response": parsed_response,
-                "timestamp": datetime.now().isoformat(),
-                "model": self.model,
-                "metrics": {
-                    "tokens_prompt": prompt_tokens,
-                    "tokens_completion": completion_tokens,
-                    "total_tokens": total_tokens,
-                    "latency_ms": latency_ms,
-                    "estimated_cost": round(estimated_cost, 6)
-                }
-            }
+            to_send.append((i, user_question, cache_key, question_vector))
+        
+        return results, to_send
+    
+    def process_queries_combined(self, questions: List[str],
+                                 check_safety: bool = True) -> List[Dict[str, Any]]:
+        """
+        Answer several questions with a single chat completion.
+        
+        Rejected and cached questions are handled first; the rest are packed
+        into one prompt that asks for {"responses": [...]}, one answer per
+        question in order. Meant for small sets such as smoke tests; each
+        result's metrics carry an even share of the call's tokens.
+        
+        Args:
+            questions: The user's questions
+            check_safety: Whether to check for adversarial prompts
             
-            # Log metrics
-            self._log_metrics(result["metrics"], user_question)
+        Returns:
+            One result dictionary per question, in the same order
+        """
+        start_time = time.time()
+        results, to_send = self._preflight_many(questions, check_safety, start_time)
+        if not to_send:
+            return results
+        
+        numbered = "\n".join(f"{n}. {item[1]}" for n, item in enumerate(to_send, 1))
+        instruction = (
+            f"\n\nThe user question above is a numbered list of {len(to_send)} questions. "
+            'Return a JSON object {"responses": [...]} with one response object in the '
+            "format above per question, in the same order."
+        )
+        
+        # Each question fit the budget alone; the combined prompt must fit it too
+        over_budget = self._over_budget_result(numbered, start_time, instruction)
+        if over_budget is not None:
+            for i, *_ in to_send:
+                results[i] = dict(over_budget)
+            return results
+        
+        request = self._completion_request(numbered)
+        request["messages"][1]["content"] += instruction
+        
+        try:
+            stream = self.client.chat.completions.create(**request)
+            parts: List[str] = []
+            usage = None
+            for chunk in stream:
+                usage = self._read_chunk(chunk, parts) or usage
+            content = "".join(parts)
             
-            return result
+            responses = json_utils.loads(content).get("responses")
+            if not isinstance(responses, list) or len(responses) != len(to_send):
+                raise ValueError(f"Expected {len(to_send)} responses in the combined answer")
             
-        except json.JSONDecodeError as e:
-            return {
-                "status": "error",
-                "error": f"Failed to parse JSON response: {str(e)}",
-                "timestamp": datetime.now().isoformat()
-            }
+            if usage is None:
+                usage = self._estimate_usage(numbered, content, instruction)
+            shares = self._split_usage(usage, len(to_send))
         except Exception as e:
-            return {
-                "status": "error",
-                "error": str(e),
-                "timestamp": datetime.now().isoformat()
-            }
+            for i, *_ in to_send:
+                results[i] = self._error_result(e)
+            return results
+        
+        for (i, user_question, cache_key, question_vector), response, share in zip(
+                to_send, responses, shares):
+            try:
+                parsed_response = schemas.validate_response(response)
+            except schemas.ValidationError as e:
+                results[i] = self._invalid_result(e, share, user_question, start_time)
+                continue
+            try:
+                results[i] = self._success_result(parsed_response, share, user_question,
+                                                  cache_key, question_vector, start_time)
+            except Exception as e:
+                results[i] = self._error_result(e)
+        
+        return results
     
-    def _log_metrics(self, metrics: Dict[str, Any], question: str):
-        """Log metrics to CSV file."""
-        metrics_dir = Path(__file__).parent.parent / "metrics"
-        metrics_dir.mkdir(exist_ok=True)
+    @staticmethod
+    def _split_usage(usage: Optional[CompletionUsage], count: int) -> List[Optional[CompletionUsage]]:
+        """Divide one call's token usage evenly across count answers."""
+        if usage is None:
+            return [None] * count
+        
+        shares = []
+        for n in range(count):
+            # Spread the remainders over the first answers so the totals add up
+            prompt_tokens = usage.prompt_tokens // count + (n < usage.prompt_tokens % count)
+            completion_tokens = (usage.completion_tokens // count
+                                 + (n < usage.completion_tokens % count))
+            shares.append(CompletionUsage(prompt_tokens=prompt_tokens,
+                                          completion_tokens=completion_tokens,
+                                          total_tokens=prompt_tokens + completion_tokens))
+        return shares
+    
+    def process_queries_batch(self, questions: List[str], check_safety: bool = True,
+                              poll_interval: float = 30,
+                              max_poll_interval: float = 600) -> List[Dict[str, Any]]:
+        """
+        Process many questions offline through the OpenAI Batch API.
+        
+        Questions that are rejected or cached are answered locally; the rest
+        are uploaded as one batch job, which is polled until it finishes.
+        Batch jobs cost half as much but may take up to 24 hours.
+        
+        Args:
+            questions: The user's questions
+            check_safety: Whether to check for adversarial prompts
+            poll_interval: Seconds before the first status check
+            max_poll_interval: Upper bound for the doubling poll interval
+            
+        Returns:
+            One result dictionary per question, in the same order
+        """
+        start_time = time.time()
+        results, to_send = self._preflight_many(questions, check_safety, start_time)
+        pending: Dict[str, tuple] = {}
+        lines: List[bytes] = []
+        
+        for i, user_question, cache_key, question_vector in to_send:
+            # Batch requests cannot stream
+            body = self._completion_request(user_question)
+            body.pop("stream")
+            body.pop("stream_options")
+            custom_id = f"q{i}"
+            pending[custom_id] = (i, user_question, cache_key, question_vector)
+            lines.append(json_utils.dumps_line({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }))
+        
+        if pending:
+            try:
+                for custom_id, outcome in self._run_batch(lines, poll_interval, max_poll_interval):
+                    i, user_question, cache_key, question_vector = pending.pop(custom_id)
+                    results[i] = self._batch_result(outcome, user_question, cache_key,
+                                                    question_vector, start_time)
+                for i, *_ in pending.values():
+                    results[i] = self._error_result(RuntimeError("No batch output for request"))
+            except Exception as e:
+                for i, *_ in pending.values():
+                    results[i] = self._error_result(e)
         
-        csv_path = metrics_dir / "metrics.csv"
-        json_path = metrics_dir / "metrics.json"
+        return results
+    
+    def _run_batch(self, lines: List[bytes], poll_interval: float,
+                   max_poll_interval: float) -> Iterator[tuple]:
+        """
+        Upload request lines as a batch job, wait for it, and stream its output.
+        
+        Yields:
+            Tuples of (custom_id, output record) for every finished request
+        """
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", b"".join(lines)),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
         
-        # Prepare metrics entry
+        # Poll with exponential backoff until the job reaches a terminal state
+        delay = poll_interval
+        while batch.status not in self.BATCH_TERMINAL_STATUSES:
+            time.sleep(delay)
+            delay = min(delay * 2, max_poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+        
+        # Successful requests land in the output file, failed ones in the error file
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).content.splitlines():
+                if line.strip():
+                    record = json_utils.loads(line)
+                    yield record["custom_id"], record
+        
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+    
+    def _batch_result(self, record: Dict[str, Any], user_question: str, cache_key: str,
+                      question_vector, start_time: float) -> Dict[str, Any]:
+        """Turn one Batch API output record into the result dictionary."""
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            error = record.get("error") or response.get("body", {}).get("error")
+            return self._error_result(RuntimeError(f"Batch request failed: {error}"))
+        
+        body = response["body"]
+        usage = CompletionUsage.model_validate(body["usage"]) if body.get("usage") else None
+        try:
+            return self._finish_query(body["choices"][0]["message"]["content"], usage,
+                                      user_question, cache_key, question_vector, start_time,
+                                      price_factor=self.BATCH_PRICE_FACTOR)
+        except Exception as e:
+            return self._error_result(e)
+    
+    def _log_metrics(self, metrics: Dict[str, Any], question: str, timestamp: str):
+        """Log metrics, stamped with the result's timestamp, to the CSV and JSON Lines files."""
+        if self._jsonl_fh is None:
+            self._open_metrics_logs()
+        
+        # Prepare metrics entry; metrics already holds the numeric columns in order
         entry = {
-            "timestamp": datetime.now().isoformat(),
-            "tokens_prompt": metrics["tokens_prompt"],
-            "tokens_completion": metrics["tokens_completion"],
-            "total_tokens": metrics["total_tokens"],
-            "latency_ms": metrics["latency_ms"],
-            "estimated_cost": metrics["estimated_cost"],
+            "timestamp": timestamp,
+            **metrics,
             "model": self.model,
-            "question_preview": question[:50] + "..." if len(question) > 50 else question
+            "question_preview": question[:50]
         }
         
-        # Log to CSV
-        import csv
-        file_exists = csv_path.exists()
-        with open(csv_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=entry.keys())
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(entry)
-        
-        # Log to JSON (append to array)
-        if json_path.exists():
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = []
+        # Both logs are written through long-lived handles and flushed per entry,
+        # so other TextUtility instances appending to the same files and readers
+        # in this process always see complete, ordered rows
+        self._csv_writer.writerow(entry)
+        self._csv_fh.flush()
+        
+        # Log to JSON Lines (pure append, one entry per line)
+        self._jsonl_fh.write(json_utils.dumps_line(entry))
+        self._jsonl_fh.flush()
+    
+    def _open_metrics_logs(self):
+        """Open the metrics CSV and JSON Lines logs for appending."""
+        metrics_dir = METRICS_DIR
+        metrics_dir.mkdir(exist_ok=True)
         
-        data.append(entry)
+        self._csv_fh = open(metrics_dir / "metrics.csv", 'a', newline='', encoding='utf-8',
+                            buffering=1 << 16)
+        self._csv_writer = csv.DictWriter(self._csv_fh, fieldnames=self.METRICS_FIELDNAMES)
+        if self._csv_fh.tell() == 0:
+            # Flush the header at once so another instance sees a non-empty file
+            self._csv_writer.writeheader()
+            self._csv_fh.flush()
         
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
+        self._jsonl_fh = open(metrics_dir / "metrics.jsonl", 'ab', buffering=1 << 16)
+
+
+def iter_metrics(jsonl_path: Optional[Path] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream logged metrics entries one at a time.
+    
+    A path ending in .json is read as a JSON array (a compacted or legacy
+    metrics.json); anything else is read as JSON Lines.
+    
+    Args:
+        jsonl_path: Metrics log to read (defaults to metrics/metrics.jsonl)
+        
+    Yields:
+        One metrics entry per logged query
+    """
+    path = Path(jsonl_path or METRICS_DIR / "metrics.jsonl")
+    if path.suffix == ".json":
+        return json_utils.iter_json_array(path)
+    return json_utils.iter_jsonl(path)
+
+
+def summarize_metrics(jsonl_path: Optional[Path] = None) -> Dict[str, Any]:
+    """
+    Aggregate the metrics log in a single streaming pass.
+    
+    With numpy installed the columns are collected into one structured array
+    and reduced in C; otherwise the totals are accumulated in Python.
+    
+    Args:
+        jsonl_path: Metrics log to read (defaults to metrics/metrics.jsonl)
+        
+    Returns:
+        Dictionary with count, total_cost, total_tokens and avg_latency_ms
+    """
+    rows = (
+        (entry.get("estimated_cost", 0.0), entry.get("total_tokens", 0), entry.get("latency_ms", 0))
+        for entry in iter_metrics(jsonl_path)
+    )
+    
+    # Imported here rather than at module level: numpy is slow to import and
+    # only this report needs it
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    
+    if np is not None:
+        table = np.fromiter(rows, dtype=[("cost", np.float64), ("tokens", np.int64),
+                                         ("latency", np.int64)])
+        count = len(table)
+        total_cost = float(table["cost"].sum())
+        total_tokens = int(table["tokens"].sum())
+        total_latency = float(table["latency"].sum())
+    else:
+        count = total_tokens = 0
+        total_cost = total_latency = 0.0
+        for cost, tokens, latency in rows:
+            count += 1
+            total_cost += cost
+            total_tokens += tokens
+            total_latency += latency
+    
+    return {
+        "count": count,
+        "total_cost": total_cost,
+        "total_tokens": total_tokens,
+        "avg_latency_ms": total_latency / count if count else 0.0
+    }
+
+
+def compact_metrics(jsonl_path: Optional[Path] = None,
+                    json_path: Optional[Path] = None) -> int:
+    """
+    Write the JSON Lines metrics log out as a single JSON array.
+    
+    Args:
+        jsonl_path: Metrics log to read (defaults to metrics/metrics.jsonl)
+        json_path: Array file to write (defaults to metrics/metrics.json)
+        
+    Returns:
+        Number of entries written
+    """
+    return json_utils.compact_jsonl(jsonl_path or METRICS_DIR / "metrics.jsonl",
+                                    json_path or METRICS_DIR / "metrics.json")
 
 
 def main():
@@ -226,12 +1131,10 @@ def main():
     # Get question from command line
     question = " ".join(sys.argv[1:])
     
-    # Initialize utility
-    utility = TextUtility()
-    
-    # Process query
+    # Initialize utility and process query
     print(f"Processing question: {question}\n")
-    result = utility.process_query(question)
+    with TextUtility() as utility:
+        result = utility.process_query(question)
     
     # Print result as formatted JSON
     print(json.dumps(result, indent=2))
@@ -4,8 +4,22 @@ Handles adversarial prompt detection and content moderation
 """
 
 import re
-from typing import Dict, Any, List
-from openai import OpenAI
+import asyncio
+import contextlib
+import functools
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, ClassVar, List, Optional, Tuple
+from openai import OpenAI, AsyncOpenAI
+
+from src import json_utils
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+LOG_DIR = Path(__file__).parent.parent / "metrics"
 
 
 class SafetyChecker:
@@ -14,103 +28,302 @@ class SafetyChecker:
     Uses OpenAI's moderation API and custom heuristics.
     """
     
-    def __init__(self, client: OpenAI):
-        """Initialize safety checker with OpenAI client."""
+    # Prompts longer than this are rejected before any pattern is run
+    MAX_PROMPT_CHARS: ClassVar[int] = 10 * 1024 * 1024
+    
+    # Heuristic verdicts for prompts up to this length are memoized
+    CACHEABLE_PROMPT_CHARS: ClassVar[int] = 4096
+    
+    # Prompts sent per moderation request by check_prompts
+    MODERATION_BATCH_SIZE: ClassVar[int] = 32
+    
+    # Adversarial prompt patterns, compiled together into _union_pattern below
+    ADVERSARIAL_PATTERNS: ClassVar[Tuple[str, ...]] = (
+        r"ignore\s+(?:all\s+)?(?:previous\s+|above\s+)?instructions?",
+        r"ignore\s+(?:the\s+)?(?:previous\s+)?(?:all\s+)?instructions?",
+        r"disregard\s+(?:all\s+)?(?:previous\s+|your\s+)?(?:instructions?|rules?)",
+        r"forget\s+(?:everything|all|instructions?)",
+        r"you\s+are\s+now\s+(?:a|an)\s+",
+        r"new\s+instructions?:",
+        r"system\s+prompt:",
+        r"reveal\s+your\s+(?:prompt|instructions?|system)",
+        r"what\s+(?:is|are)\s+your\s+(?:instructions?|rules?|prompt)",
+        r"(?:prompt|system)\s+injection",
+        r"jailbreak",
+    )
+    
+    # All patterns fused into one alternation so the prompt is scanned once;
+    # group "p<i>" identifies which pattern matched
+    _union_pattern: ClassVar[re.Pattern] = re.compile(
+        "|".join(f"(?P<p{i}>{pattern})" for i, pattern in enumerate(ADVERSARIAL_PATTERNS)),
+        re.IGNORECASE
+    )
+    
+    # Hyperscan database shared by all instances, compiled on first scan
+    _hs_db = None
+    _hs_db_ready = False
+    
+    def __init__(self, client: OpenAI, async_client: Optional[AsyncOpenAI] = None):
+        """Initialize safety checker with OpenAI client (and optional async client)."""
         self.client = client
+        self.async_client = async_client
+        
+        # Safety log lines waiting to be written, keyed by log file
+        self._pending_logs: Dict[Path, List[bytes]] = {}
+        self._log_batch_depth = 0
+    
+    @classmethod
+    def _hyperscan_db(cls):
+        """Return the shared Hyperscan database, or None if unavailable."""
+        if not cls._hs_db_ready:
+            cls._hs_db = cls._build_hyperscan_db()
+            cls._hs_db_ready = True
+        return cls._hs_db
+    
+    @classmethod
+    def _build_hyperscan_db(cls):
+        """Compile the patterns into a Hyperscan database, or None if unavailable."""
+        if hyperscan is None:
+            return None
+        
+        count = len(cls.ADVERSARIAL_PATTERNS)
+        try:
+            db = hyperscan.Database()
+            db.compile(
+                expressions=[cls._hyperscan_expression(pattern).encode()
+                             for pattern in cls.ADVERSARIAL_PATTERNS],
+                ids=list(range(count)),
+                elements=count,
+                # Only whether a pattern matches matters, so report each at most once
+                flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * count
+            )
+        except hyperscan.error:
+            return None
+        return db
+    
+    @staticmethod
+    def _hyperscan_expression(pattern: str) -> str:
+        """
+        Translate a pattern for Hyperscan.
         
-        # Adversarial prompt patterns
-        self.adversarial_patterns = [
-            r"ignore\s+(?:all\s+)?(?:previous\s+|above\s+)?instructions?",
-            r"ignore\s+(?:the\s+)?(?:previous\s+)?(?:all\s+)?instructions?",
-            r"disregard\s+(?:all\s+)?(?:previous\s+|your\s+)?(?:instructions?|rules?)",
-            r"forget\s+(?:everything|all|instructions?)",
-            r"you\s+are\s+now\s+(?:a|an)\s+",
-            r"new\s+instructions?:",
-            r"system\s+prompt:",
-            r"reveal\s+your\s+(?:prompt|instructions?|system)",
-            r"what\s+(?:is|are)\s+your\s+(?:instructions?|rules?|prompt)",
-            r"(?:prompt|system)\s+injection",
-            r"jailbreak",
-        ]
-        
-        self.compiled_patterns = [re.compile(pattern, re.IGNORECASE) 
-                                 for pattern in self.adversarial_patterns]
-    
-    def check_prompt(self, prompt: str) -> Dict[str, Any]:
+        Python's \\s also matches the ASCII separators \\x1c-\\x1f, which
+        Hyperscan's \\s does not; spell the class out so both engines agree.
+        (The patterns only use \\s outside character classes.)
+        """
+        return pattern.replace(r"\s", r"[\t\n\v\f\r \x1c-\x1f]")
+    
+    @staticmethod
+    def _hyperscan_hit(hs_db, prompt: str) -> bool:
+        """Return True if any pattern matches, stopping at the first hit."""
+        hits = []
+        
+        def on_match(pattern_id, start, end, flags, context):
+            hits.append(pattern_id)
+            return True  # halt the scan
+        
+        try:
+            hs_db.scan(prompt.encode(), match_event_handler=on_match)
+        except hyperscan.ScanTerminated:
+            pass
+        return bool(hits)
+    
+    def check_prompt(self, prompt: str, fast_reject: bool = True) -> Dict[str, Any]:
         """
         Check if a prompt is safe or adversarial.
         
         Args:
             prompt: The user prompt to check
+            fast_reject: Skip the moderation API when the heuristics already
+                flag the prompt (set False for a full audit)
             
         Returns:
             Dictionary with safety analysis results
         """
-        result = {
-            "is_safe": True,
-            "flagged_by": [],
-            "moderation_results": None,
-            "heuristic_matches": []
-        }
+        result = self._new_result()
+        
+        # Cheap local heuristics first; obvious attacks never reach the network
+        self._apply_heuristics(result, prompt)
+        if fast_reject and not result["is_safe"]:
+            return result
         
         # Check with OpenAI Moderation API
         try:
             moderation = self.client.moderations.create(input=prompt)
+            self._apply_moderation(result, moderation)
+        except Exception as e:
+            # Silently handle moderation API errors - rely on heuristic patterns
+            result["moderation_error"] = str(e)
+        
+        return result
+    
+    async def check_prompt_async(self, prompt: str, fast_reject: bool = True) -> Dict[str, Any]:
+        """
+        Async variant of check_prompt.
+        
+        As in check_prompt, the local heuristics run first and the moderation
+        request is only sent for prompts they do not flag.
+        
+        Args:
+            prompt: The user prompt to check
+            fast_reject: Skip the moderation API when the heuristics already
+                flag the prompt (set False for a full audit)
             
-            # Handle different response formats
-            if hasattr(moderation, 'results') and len(moderation.results) > 0:
-                mod_result = moderation.results[0]
-                
-                result["moderation_results"] = {
-                    "flagged": mod_result.flagged,
-                    "categories": {}
-                }
-                
-                # Safely extract categories
-                if hasattr(mod_result, 'categories'):
-                    categories = mod_result.categories
-                    # Convert to dict if it's an object
-                    if hasattr(categories, '__dict__'):
-                        result["moderation_results"]["categories"] = {
-                            k: v for k, v in categories.__dict__.items()
-                            if not k.startswith('_')
-                        }
-                    elif hasattr(categories, 'model_dump'):
-                        result["moderation_results"]["categories"] = categories.model_dump()
-                    else:
-                        # Try to access common category attributes
-                        category_names = ['hate', 'hate/threatening', 'harassment', 
-                                        'harassment/threatening', 'self-harm', 
-                                        'self-harm/intent', 'self-harm/instructions',
-                                        'sexual', 'sexual/minors', 'violence', 
-                                        'violence/graphic']
-                        for cat in category_names:
-                            try:
-                                result["moderation_results"]["categories"][cat] = getattr(categories, cat.replace('/', '_').replace('-', '_'), False)
-                            except:
-                                pass
-                
-                if mod_result.flagged:
-                    result["is_safe"] = False
-                    result["flagged_by"].append("openai_moderation")
+        Returns:
+            Dictionary with safety analysis results
+        """
+        result = self._new_result()
         
+        # Cheap local heuristics first; obvious attacks never reach the network
+        self._apply_heuristics(result, prompt)
+        if fast_reject and not result["is_safe"]:
+            return result
+        
+        try:
+            self._apply_moderation(result, await self._moderate_async(prompt))
         except Exception as e:
             # Silently handle moderation API errors - rely on heuristic patterns
             result["moderation_error"] = str(e)
         
-        # Check with heuristic patterns
-        for pattern in self.compiled_patterns:
-            matches = pattern.findall(prompt)
-            if matches:
+        return result
+    
+    def check_prompts(self, prompts: List[str], fast_reject: bool = True) -> List[Dict[str, Any]]:
+        """
+        Check several prompts, sending one moderation request per chunk of prompts.
+        
+        Args:
+            prompts: The user prompts to check
+            fast_reject: Skip the moderation API for prompts the heuristics
+                already flag (set False for a full audit)
+            
+        Returns:
+            One safety analysis result per prompt, in the same order
+        """
+        results = [self._new_result() for _ in prompts]
+        to_moderate = []
+        for result, prompt in zip(results, prompts):
+            self._apply_heuristics(result, prompt)
+            if result["is_safe"] or not fast_reject:
+                to_moderate.append((result, prompt))
+        
+        # The moderation endpoint takes a list input and answers in order
+        for start in range(0, len(to_moderate), self.MODERATION_BATCH_SIZE):
+            chunk = to_moderate[start:start + self.MODERATION_BATCH_SIZE]
+            try:
+                moderation = self.client.moderations.create(input=[prompt for _, prompt in chunk])
+                for index, (result, _) in enumerate(chunk):
+                    self._apply_moderation(result, moderation, index)
+            except Exception as e:
+                # Silently handle moderation API errors - rely on heuristic patterns
+                for result, _ in chunk:
+                    result["moderation_error"] = str(e)
+        
+        return results
+    
+    async def _moderate_async(self, prompt: str):
+        """Call the moderation API without blocking the event loop."""
+        if self.async_client is not None:
+            return await self.async_client.moderations.create(input=prompt)
+        return await asyncio.to_thread(self.client.moderations.create, input=prompt)
+    
+    def _new_result(self) -> Dict[str, Any]:
+        """Return an empty (safe) analysis result."""
+        return {
+            "is_safe": True,
+            "flagged_by": [],
+            "moderation_results": None,
+            "heuristic_matches": []
+        }
+    
+    def _apply_moderation(self, result: Dict[str, Any], moderation, index: int = 0):
+        """Record an OpenAI moderation response (its index-th input) in the analysis result."""
+        # Handle different response formats
+        if hasattr(moderation, 'results') and len(moderation.results) > index:
+            mod_result = moderation.results[index]
+            
+            result["moderation_results"] = {
+                "flagged": mod_result.flagged,
+                "categories": {}
+            }
+            
+            # Safely extract categories
+            if hasattr(mod_result, 'categories'):
+                categories = mod_result.categories
+                # Convert to dict if it's an object
+                if hasattr(categories, '__dict__'):
+                    result["moderation_results"]["categories"] = {
+                        k: v for k, v in categories.__dict__.items()
+                        if not k.startswith('_')
+                    }
+                elif hasattr(categories, 'model_dump'):
+                    result["moderation_results"]["categories"] = categories.model_dump()
+                else:
+                    # Try to access common category attributes
+                    category_names = ['hate', 'hate/threatening', 'harassment', 
+                                    'harassment/threatening', 'self-harm', 
+                                    'self-harm/intent', 'self-harm/instructions',
+                                    'sexual', 'sexual/minors', 'violence', 
+                                    'violence/graphic']
+                    for cat in category_names:
+                        try:
+                            result["moderation_results"]["categories"][cat] = getattr(categories, cat.replace('/', '_').replace('-', '_'), False)
+                        except:
+                            pass
+            
+            if mod_result.flagged:
                 result["is_safe"] = False
-                if "heuristic_patterns" not in result["flagged_by"]:
-                    result["flagged_by"].append("heuristic_patterns")
-                result["heuristic_matches"].append({
-                    "pattern": pattern.pattern,
-                    "matches": matches
-                })
+                result["flagged_by"].append("openai_moderation")
+    
+    def _apply_heuristics(self, result: Dict[str, Any], prompt: str):
+        """Record heuristic pattern matches in the analysis result."""
+        # Oversized inputs are refused outright rather than scanned
+        if len(prompt) > self.MAX_PROMPT_CHARS:
+            result["is_safe"] = False
+            result["flagged_by"].append("oversized_input")
+            return
         
-        return result
+        # Repeated short prompts (canned greetings, known attacks) skip the scan
+        if len(prompt) <= self.CACHEABLE_PROMPT_CHARS:
+            matches = self._cached_scan(prompt)
+        else:
+            matches = self._scan(prompt)
+        if not matches:
+            return
+        
+        # Each source is recorded once, however many patterns matched
+        result["is_safe"] = False
+        result["flagged_by"].append("heuristic_patterns")
+        for index, found in matches:
+            result["heuristic_matches"].append({
+                "pattern": self.ADVERSARIAL_PATTERNS[index],
+                "matches": list(found)
+            })
+    
+    @classmethod
+    def _scan(cls, prompt: str) -> Tuple[Tuple[int, Tuple[str, ...]], ...]:
+        """
+        Run the heuristic patterns over a prompt.
+        
+        Returns:
+            (pattern index, matched texts) pairs in pattern order; empty if clean
+        """
+        # Check with heuristic patterns (single pass over the prompt). Hyperscan's
+        # DFA screens out clean prompts; Python's re then extracts the matches.
+        # Its caseless mode is ASCII-only, so other prompts always go to re.
+        matches_by_pattern: Dict[int, List[str]] = {}
+        hs_db = cls._hyperscan_db()
+        if hs_db is None or not prompt.isascii() or cls._hyperscan_hit(hs_db, prompt):
+            for match in cls._union_pattern.finditer(prompt):
+                index = int(match.lastgroup[1:])
+                matches_by_pattern.setdefault(index, []).append(match.group())
+        
+        return tuple((index, tuple(matches_by_pattern[index]))
+                     for index in sorted(matches_by_pattern))
+    
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _cached_scan(cls, prompt: str) -> Tuple[Tuple[int, Tuple[str, ...]], ...]:
+        """_scan memoized per prompt; the result is immutable so it is safe to share."""
+        return cls._scan(prompt)
     
     def get_safe_response(self, safety_result: Dict[str, Any]) -> str:
         """
@@ -130,23 +343,25 @@ class SafetyChecker:
             return ("I detected a potential prompt injection attempt. I'm designed to "
                    "assist with legitimate questions. Please ask a genuine question.")
         
+        if "oversized_input" in safety_result["flagged_by"]:
+            return "This prompt is too long to process. Please shorten your question."
+        
         return "This prompt cannot be processed due to safety concerns."
     
     def log_safety_decision(self, prompt: str, safety_result: Dict[str, Any], 
-                           response: str, log_file: str = "safety_log.json"):
+                           response: str, log_file: str = "safety_log.jsonl"):
         """
         Log safety decisions for auditing purposes.
         
+        Entries are appended to a JSON Lines file; inside open_log_batch()
+        they are buffered and written when the batch ends.
+        
         Args:
             prompt: The original user prompt
             safety_result: Safety analysis result
             response: The response that was given
-            log_file: Path to log file
+            log_file: Log file name within the metrics directory
         """
-        import json
-        from datetime import datetime
-        from pathlib import Path
-        
         log_entry = {
             "timestamp": datetime.now().isoformat(),
             "prompt_preview": prompt[:100] + "..." if len(prompt) > 100 else prompt,
@@ -155,22 +370,45 @@ class SafetyChecker:
             "response": response
         }
         
-        log_path = Path(__file__).parent.parent / "metrics" / log_file
-        log_path.parent.mkdir(exist_ok=True)
-        
-        # Append to log file
-        logs = []
-        if log_path.exists():
-            with open(log_path, 'r', encoding='utf-8') as f:
-                try:
-                    logs = json.load(f)
-                except json.JSONDecodeError:
-                    logs = []
-        
-        logs.append(log_entry)
+        log_path = LOG_DIR / log_file
+        self._pending_logs.setdefault(log_path, []).append(json_utils.dumps_line(log_entry))
+        if self._log_batch_depth == 0:
+            self.flush_logs()
+    
+    def flush_logs(self):
+        """Append all buffered safety log entries to their files."""
+        for log_path, lines in self._pending_logs.items():
+            log_path.parent.mkdir(exist_ok=True)
+            with open(log_path, 'ab', buffering=1 << 15) as f:
+                f.write(b"".join(lines))
+        self._pending_logs.clear()
+    
+    @contextlib.contextmanager
+    def open_log_batch(self):
+        """Defer safety log writes until the outermost batch exits."""
+        self._log_batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._log_batch_depth -= 1
+            if self._log_batch_depth == 0:
+                self.flush_logs()
+
+
+def compact_safety_log(jsonl_path: Optional[Path] = None,
+                       json_path: Optional[Path] = None) -> int:
+    """
+    Write the JSON Lines safety log out as a single JSON array.
+    
+    Args:
+        jsonl_path: Safety log to read (defaults to metrics/safety_log.jsonl)
+        json_path: Array file to write (defaults to metrics/safety_log.json)
         
-        with open(log_path, 'w', encoding='utf-8') as f:
-            json.dump(logs, f, indent=2)
+    Returns:
+        Number of entries written
+    """
+    return json_utils.compact_jsonl(jsonl_path or LOG_DIR / "safety_log.jsonl",
+                                    json_path or LOG_DIR / "safety_log.json")
 
 
 def test_adversarial_prompts():
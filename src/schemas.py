@@ -0,0 +1,138 @@
+"""
+Response Schemas for Multi-Task Text Utility
+JSON Schemas for model answers and query results, with cached validators
+"""
+
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+# The JSON object the prompt template asks the model to return
+RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "required": ["question_type", "answer", "confidence"],
+    "properties": {
+        "question_type": {"type": "string"},
+        "answer": {"type": "string"},
+        "confidence": {"type": "string", "enum": ["high", "medium", "low"]},
+        "additional_context": {"type": ["string", "null"]}
+    }
+}
+
+# A successful TextUtility result wrapping the model's answer
+RESULT_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "required": ["status", "response", "metrics"],
+    "properties": {
+        "status": {"type": "string"},
+        "response": RESPONSE_SCHEMA,
+        "metrics": {
+            "type": "object",
+            "required": ["tokens_prompt", "tokens_completion", "total_tokens",
+                         "latency_ms", "estimated_cost"],
+            "properties": {
+                "tokens_prompt": {"type": "integer"},
+                "tokens_completion": {"type": "integer"},
+                "total_tokens": {"type": "integer"},
+                "latency_ms": {"type": "integer"},
+                "estimated_cost": {"type": "number"}
+            }
+        }
+    }
+}
+
+
+if fastjsonschema is not None:
+    ValidationError = fastjsonschema.JsonSchemaValueException
+else:
+    class ValidationError(ValueError):
+        """Raised when a document does not match its schema."""
+
+
+# Compiled validators, built once per schema
+_VALIDATORS: Dict[int, Callable[[Any], Any]] = {}
+
+_TYPE_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    "object": lambda value: isinstance(value, dict),
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "null": lambda value: value is None,
+}
+
+
+def _type_check(type_name) -> Optional[Callable[[Any], bool]]:
+    """Return the check for a schema "type", which may be a list of alternatives."""
+    if isinstance(type_name, list):
+        checks = [_TYPE_CHECKS[name] for name in type_name]
+        return lambda value: any(check(value) for check in checks)
+    return _TYPE_CHECKS.get(type_name)
+
+
+def _compile_fallback(schema: Dict[str, Any], path: str = "data") -> Callable[[Any], Any]:
+    """
+    Build a validator for the schema subset used here (type, enum, required,
+    properties) when fastjsonschema is not installed.
+    """
+    type_check = _type_check(schema.get("type"))
+    enum = schema.get("enum")
+    required_order = schema.get("required", ())
+    required = frozenset(required_order)
+    properties = {
+        name: _compile_fallback(subschema, f"{path}.{name}")
+        for name, subschema in schema.get("properties", {}).items()
+    }
+    
+    def validate(value):
+        if type_check is not None and not type_check(value):
+            raise ValidationError(f"{path} must be {schema['type']}")
+        if enum is not None and value not in enum:
+            raise ValidationError(f"{path} must be one of {enum}")
+        # One set difference instead of a membership test per required key
+        if required:
+            missing = required - value.keys()
+            if missing:
+                names = [name for name in required_order if name in missing]
+                raise ValidationError(f"{path} must contain {names} properties")
+        for name, check in properties.items():
+            if name in value:
+                check(value[name])
+        return value
+    
+    return validate
+
+
+def validator(schema: Dict[str, Any]) -> Callable[[Any], Any]:
+    """
+    Return the compiled validator for a schema, compiling it on first use.
+    
+    Args:
+        schema: A JSON Schema dictionary (kept alive for the process lifetime)
+    
+    Returns:
+        A function that returns the document or raises ValidationError
+    """
+    validate = _VALIDATORS.get(id(schema))
+    if validate is None:
+        if fastjsonschema is not None:
+            validate = fastjsonschema.compile(schema)
+        else:
+            validate = _compile_fallback(schema)
+        _VALIDATORS[id(schema)] = validate
+    return validate
+
+
+def validate_response(obj: Any) -> Any:
+    """Validate a parsed model answer against RESPONSE_SCHEMA, ignoring confidence case."""
+    if isinstance(obj, dict) and isinstance(obj.get("confidence"), str):
+        obj["confidence"] = obj["confidence"].strip().lower()
+    return validator(RESPONSE_SCHEMA)(obj)
+
+
+def validate_result(obj: Any) -> Any:
+    """Validate a successful query result against RESULT_SCHEMA."""
+    return validator(RESULT_SCHEMA)(obj)
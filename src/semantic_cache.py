@@ -0,0 +1,228 @@
+"""
+Semantic Cache Module for Multi-Task Text Utility
+Reuses answers for near-duplicate questions via embedding similarity
+"""
+
+import atexit
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+from openai import OpenAI
+
+from src import json_utils
+
+# numpy and faiss are slow to import, so they are loaded by the first SemanticCache
+np = None
+faiss = None
+
+
+def _import_backends():
+    """Import numpy and faiss into this module, raising ImportError if either is missing."""
+    global np, faiss
+    if np is not None and faiss is not None:
+        return
+    try:
+        import numpy
+        import faiss as faiss_module
+    except ImportError:
+        raise ImportError("Semantic caching requires the 'faiss-cpu' and 'numpy' packages.")
+    np, faiss = numpy, faiss_module
+
+
+class SemanticCache:
+    """
+    Caches responses keyed by question embeddings.
+    Uses a FAISS inner-product index over normalized OpenAI embeddings
+    (cosine similarity) and a token-overlap gate to reject unrelated hits.
+    Entries are tagged with a namespace (model and prompt template) and an
+    expiry time, so answers never leak across configurations or go stale.
+    """
+    
+    # Nearest neighbours examined per lookup, so stale or foreign entries
+    # ranked first do not hide a valid one
+    SEARCH_K = 8
+    
+    EMBEDDING_MODEL = "text-embedding-3-small"
+    EMBEDDING_DIM = 1536
+    
+    # Inputs per embeddings request (the API accepts up to 2048)
+    EMBED_BATCH_SIZE = 2048
+    
+    def __init__(self, client: OpenAI, threshold: float = 0.95,
+                 min_jaccard: float = 0.3, index_path: Optional[str] = None,
+                 ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        Initialize the semantic cache.
+        
+        Args:
+            client: OpenAI client used for embeddings
+            threshold: Minimum cosine similarity for a cache hit
+            min_jaccard: Minimum token overlap with the cached question
+            index_path: Where to persist the FAISS index
+            ttl: Seconds an entry stays valid (None keeps entries forever)
+            max_entries: Most entries kept; expired and then the oldest entries
+                are evicted first (None is unbounded)
+        """
+        _import_backends()
+        
+        self.client = client
+        self.threshold = threshold
+        self.min_jaccard = min_jaccard
+        self.ttl = ttl
+        self.max_entries = max_entries
+        
+        if index_path is None:
+            index_path = Path(__file__).parent.parent / "metrics" / "semantic_cache.faiss"
+        self.index_path = Path(index_path)
+        self.entries_path = self.index_path.with_suffix(".json")
+        
+        self._index = faiss.IndexFlatIP(self.EMBEDDING_DIM)
+        self._entries: List[Dict[str, Any]] = []
+        self._dirty = False
+        self._load()
+        
+        # Unregistered by close(), so a closed cache is not kept alive until exit
+        atexit.register(self.save)
+    
+    def _load(self):
+        """Load a previously persisted index and its cached answers."""
+        if not (self.index_path.exists() and self.entries_path.exists()):
+            return
+        
+        index = faiss.read_index(str(self.index_path))
+        with open(self.entries_path, 'rb') as f:
+            entries = json_utils.loads(f.read())
+        
+        # Ignore a persisted cache whose index and answers are out of sync
+        if index.ntotal != len(entries) or index.d != self.EMBEDDING_DIM:
+            return
+        
+        self._index = index
+        self._entries = entries
+        
+        # Drop entries that expired while the cache was on disk, and any over the cap
+        self._evict(self.max_entries)
+    
+    def _evict(self, limit: Optional[int]):
+        """Drop expired entries, then the oldest ones until at most limit remain."""
+        now = time.time()
+        keep = [i for i, entry in enumerate(self._entries) if not self._expired(entry, now)]
+        if limit is not None:
+            keep = keep[max(len(keep) - limit, 0):]
+        if len(keep) == len(self._entries):
+            return
+        
+        # A flat index has no cheap removal; rebuild it from the kept vectors
+        index = faiss.IndexFlatIP(self.EMBEDDING_DIM)
+        if keep:
+            vectors = self._index.reconstruct_n(0, self._index.ntotal)
+            index.add(np.ascontiguousarray(vectors[keep], dtype=np.float32))
+        self._index = index
+        self._entries = [self._entries[i] for i in keep]
+        self._dirty = True
+    
+    @staticmethod
+    def _expired(entry: Dict[str, Any], now: float) -> bool:
+        """Whether an entry is past its expiry time (entries without one never expire)."""
+        expires_at = entry.get("expires_at")
+        return expires_at is not None and expires_at <= now
+    
+    def save(self):
+        """Persist the index and cached answers if they changed."""
+        if not self._dirty:
+            return
+        
+        self.index_path.parent.mkdir(exist_ok=True)
+        faiss.write_index(self._index, str(self.index_path))
+        with open(self.entries_path, 'wb') as f:
+            f.write(json_utils.dumps(self._entries))
+        self._dirty = False
+    
+    def close(self):
+        """Persist the cache and drop its exit hook."""
+        self.save()
+        atexit.unregister(self.save)
+    
+    def embed(self, text: str) -> "np.ndarray":
+        """Return the normalized embedding vector for a piece of text."""
+        response = self.client.embeddings.create(model=self.EMBEDDING_MODEL, input=text)
+        return self._normalize(response.data[0].embedding)
+    
+    def embed_many(self, texts: List[str]) -> List["np.ndarray"]:
+        """Return normalized embedding vectors for several texts, batching the requests."""
+        vectors = []
+        for start in range(0, len(texts), self.EMBED_BATCH_SIZE):
+            response = self.client.embeddings.create(
+                model=self.EMBEDDING_MODEL, input=texts[start:start + self.EMBED_BATCH_SIZE]
+            )
+            vectors.extend(self._normalize(item.embedding) for item in response.data)
+        return vectors
+    
+    @staticmethod
+    def _normalize(embedding: List[float]) -> "np.ndarray":
+        """Convert an embedding to a unit-length float32 vector."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+    
+    @staticmethod
+    def _jaccard(a: str, b: str) -> float:
+        """Jaccard similarity between the lowercase token sets of two strings."""
+        tokens_a = set(a.lower().split())
+        tokens_b = set(b.lower().split())
+        if not tokens_a or not tokens_b:
+            return 0.0
+        return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+    
+    def lookup(self, question: str, vector: "np.ndarray",
+               namespace: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Find a cached result for a semantically equivalent question.
+        
+        Args:
+            question: The user's question
+            vector: Its normalized embedding (see embed)
+            namespace: Configuration the answer must come from (model and template)
+            
+        Returns:
+            The cached result, or None on a miss
+        """
+        if self._index.ntotal == 0:
+            return None
+        
+        k = min(self.SEARCH_K, self._index.ntotal)
+        scores, ids = self._index.search(vector.reshape(1, -1), k)
+        now = time.time()
+        for score, idx in zip(scores[0], ids[0]):
+            if idx < 0 or float(score) <= self.threshold:
+                break  # results are sorted by score
+            
+            entry = self._entries[int(idx)]
+            if entry.get("namespace", "") != namespace or self._expired(entry, now):
+                continue
+            
+            # Gated admission: a close embedding alone is not enough
+            if self._jaccard(question, entry["question"]) < self.min_jaccard:
+                continue
+            
+            return entry["result"]
+        
+        return None
+    
+    def add(self, question: str, vector: "np.ndarray", result: Dict[str, Any],
+            namespace: str = ""):
+        """Add a question's embedding and its result to the cache."""
+        self._index.add(np.asarray([vector], dtype=np.float32))
+        self._entries.append({
+            "question": question,
+            "result": result,
+            "namespace": namespace,
+            "expires_at": time.time() + self.ttl if self.ttl is not None else None
+        })
+        self._dirty = True
+        
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            # Evict an eighth beyond the cap so the index is not rebuilt on every add
+            self._evict(self.max_entries - self.max_entries // 8)
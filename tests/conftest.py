@@ -0,0 +1,26 @@
+"""
+Shared pytest fixtures for the Multi-Task Text Utility test suite
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add parent directory to path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.run_query import TextUtility
+
+
+@pytest.fixture(scope="session")
+def text_utility():
+    """A TextUtility shared by the whole test run, or None without OPENAI_API_KEY."""
+    if not os.getenv("OPENAI_API_KEY"):
+        yield None
+        return
+
+    utility = TextUtility()
+    yield utility
+    utility.close()
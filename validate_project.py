@@ -6,21 +6,139 @@ Verifies that all required deliverables are present and correctly structured
 
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 
 class ProjectValidator:
     """Validates project structure and deliverables."""
     
+    # Directories never inspected by the checks; not walked
+    SKIP_DIRS = {".git", "__pycache__", ".pytest_cache", "venv", ".venv", "node_modules"}
+    
+    # Sections printed by validate_all as (title, (path, description) pairs);
+    # a trailing "/" marks a directory
+    SECTIONS = (
+        ("?? CORE APPLICATION FILES", (
+            ("src/run_query.py", "Main application script"),
+            ("src/safety.py", "Safety module"),
+            ("src/__init__.py", "Package initializer"),
+        )),
+        ("?? PROMPT TEMPLATE", (
+            ("prompts/main_prompt.txt", "Prompt template"),
+        )),
+        ("?? METRICS & LOGGING", (
+            ("metrics/", "Metrics directory"),
+        )),
+        ("?? DOCUMENTATION", (
+            ("README.md", "README"),
+            ("reports/PI_report_en.md", "Technical report"),
+        )),
+        ("?? TESTING", (
+            ("tests/test_core.py", "Test suite"),
+        )),
+        ("??  CONFIGURATION", (
+            ("requirements.txt", "Dependencies file"),
+        )),
+        ("?? BONUS FILES", (
+            ("demo.py", "Demo script"),
+            ("QUICKSTART.md", "Quick start guide"),
+            ("PROJECT_SUMMARY.md", "Project summary"),
+        )),
+    )
+    
+    # Content checks as (filepath, required_strings, description); each runs right
+    # after its file's existence check, and the files are prefetched from this list
+    CONTENT_CHECKS = (
+        ("src/run_query.py", ["TextUtility", "OpenAI", "process_query", "metrics"],
+         "Main app has required classes/functions"),
+        ("src/safety.py", ["SafetyChecker", "check_prompt", "adversarial"],
+         "Safety module has required functionality"),
+        ("prompts/main_prompt.txt", ["INSTRUCTIONS", "Example", "{question}", "JSON"],
+         "Prompt has instructions and examples"),
+        ("README.md", ["Setup", "Installation", "Usage", "Metrics"],
+         "README has required sections"),
+        ("reports/PI_report_en.md", ["Architecture", "Prompt", "Metrics", "Safety"],
+         "Report has required sections"),
+        ("tests/test_core.py",
+         ["test_", "assert", "pytest", "TestJSONValidation", "TestTokenCounting"],
+         "Tests have proper structure"),
+        ("requirements.txt", ["openai", "pytest"],
+         "Required dependencies listed"),
+    )
+    
+    # Below this many required strings, repeated `in` scans beat building an automaton
+    AHO_CORASICK_MIN_STRINGS = 4
+    
     def __init__(self):
         self.root = Path(__file__).parent
+        # Plain string root for os.path calls; no Path objects per check
+        self._root_str = os.fspath(self.root)
         self.passed = []
         self.failed = []
+        
+        # One directory walk up front; every existence check is then a set lookup
+        self._files, self._dirs = self._scan_tree()
+        self._content_cache = {}
+        self._automata = {}
+    
+    def _scan_tree(self):
+        """Collect the project's relative file and directory paths in a single walk."""
+        files, dirs = set(), set()
+        for dirpath, dirnames, filenames in os.walk(self._root_str):
+            dirnames[:] = [d for d in dirnames if d not in self.SKIP_DIRS]
+            rel_dir = os.path.relpath(dirpath, self._root_str).replace(os.sep, "/")
+            prefix = "" if rel_dir == "." else rel_dir + "/"
+            if prefix:
+                dirs.add(rel_dir)
+            files.update(prefix + name for name in filenames)
+        return files, dirs
+    
+    def _read(self, filepath):
+        """Return a file's text, reading each file at most once."""
+        content = self._content_cache.get(filepath)
+        if content is None:
+            with open(os.path.join(self._root_str, filepath), 'r', encoding='utf-8', errors='ignore') as f:
+                content = f.read()
+            self._content_cache[filepath] = content
+        return content
+    
+    def _prefetch(self, filepaths, max_workers=8):
+        """Read files into the content cache concurrently; reads release the GIL."""
+        pending = [p for p in filepaths if p in self._files and p not in self._content_cache]
+        if not pending:
+            return
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            # Each worker fills a distinct cache key, so no lock is needed
+            list(executor.map(self._read, pending))
+    
+    def _find_missing(self, content, required_strings):
+        """Return the required strings that do not occur in content."""
+        if ahocorasick is None or len(required_strings) < self.AHO_CORASICK_MIN_STRINGS:
+            return [s for s in required_strings if s not in content]
+        
+        # One Aho-Corasick pass finds every required string at once
+        key = tuple(required_strings)
+        automaton = self._automata.get(key)
+        if automaton is None:
+            automaton = ahocorasick.Automaton()
+            for s in required_strings:
+                automaton.add_word(s, s)
+            automaton.make_automaton()
+            self._automata[key] = automaton
+        
+        found = {s for _, s in automaton.iter(content)}
+        return [s for s in required_strings if s not in found]
     
     def check_file_exists(self, filepath, description):
         """Check if a file exists."""
-        full_path = self.root / filepath
-        if full_path.exists():
+        if filepath in self._files:
             self.passed.append(f"? {description}: {filepath}")
             return True
         else:
@@ -29,8 +147,7 @@ class ProjectValidator:
     
     def check_directory_exists(self, dirpath, description):
         """Check if a directory exists."""
-        full_path = self.root / dirpath
-        if full_path.exists() and full_path.is_dir():
+        if dirpath in self._dirs:
             self.passed.append(f"? {description}: {dirpath}/")
             return True
         else:
@@ -39,15 +156,13 @@ class ProjectValidator:
     
     def check_file_content(self, filepath, required_strings, description):
         """Check if file contains required content."""
-        full_path = self.root / filepath
-        if not full_path.exists():
+        if filepath not in self._files:
             self.failed.append(f"? {description}: File not found")
             return False
         
-        with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
+        content = self._read(filepath)
         
-        missing = [s for s in required_strings if s not in content]
+        missing = self._find_missing(content, required_strings)
         if not missing:
             self.passed.append(f"? {description}: Contains required content")
             return True
@@ -62,78 +177,23 @@ class ProjectValidator:
         print("="*70)
         print()
         
-        # Check main application
-        print("?? CORE APPLICATION FILES")
-        self.check_file_exists("src/run_query.py", "Main application script")
-        self.check_file_content(
-            "src/run_query.py",
-            ["TextUtility", "OpenAI", "process_query", "metrics"],
-            "Main app has required classes/functions"
-        )
-        
-        # Check safety module
-        self.check_file_exists("src/safety.py", "Safety module")
-        self.check_file_content(
-            "src/safety.py",
-            ["SafetyChecker", "check_prompt", "adversarial"],
-            "Safety module has required functionality"
-        )
-        
-        # Check package init
-        self.check_file_exists("src/__init__.py", "Package initializer")
-        
-        print()
-        print("?? PROMPT TEMPLATE")
-        self.check_file_exists("prompts/main_prompt.txt", "Prompt template")
-        self.check_file_content(
-            "prompts/main_prompt.txt",
-            ["INSTRUCTIONS", "Example", "{question}", "JSON"],
-            "Prompt has instructions and examples"
-        )
-        
-        print()
-        print("?? METRICS & LOGGING")
-        self.check_directory_exists("metrics", "Metrics directory")
-        
-        print()
-        print("?? DOCUMENTATION")
-        self.check_file_exists("README.md", "README")
-        self.check_file_content(
-            "README.md",
-            ["Setup", "Installation", "Usage", "Metrics"],
-            "README has required sections"
-        )
-        
-        self.check_file_exists("reports/PI_report_en.md", "Technical report")
-        self.check_file_content(
-            "reports/PI_report_en.md",
-            ["Architecture", "Prompt", "Metrics", "Safety"],
-            "Report has required sections"
-        )
-        
-        print()
-        print("?? TESTING")
-        self.check_file_exists("tests/test_core.py", "Test suite")
-        self.check_file_content(
-            "tests/test_core.py",
-            ["test_", "assert", "pytest", "TestJSONValidation", "TestTokenCounting"],
-            "Tests have proper structure"
-        )
-        
-        print()
-        print("??  CONFIGURATION")
-        self.check_file_exists("requirements.txt", "Dependencies file")
-        self.check_file_content(
-            "requirements.txt",
-            ["openai", "pytest"],
-            "Required dependencies listed"
-        )
-        
-        print()
-        print("?? BONUS FILES")
-        self.check_file_exists("demo.py", "Demo script")
-        self.check_file_exists("QUICKSTART.md", "Quick start guide")
-        self.check_file_exists("PROJECT_SUMMARY.md", "Project summary")
+        # Overlap the file reads up front; the checks below then run in order
+        self._prefetch([filepath for filepath, _, _ in self.CONTENT_CHECKS])
+        content_checks = {}
+        for filepath, required_strings, description in self.CONTENT_CHECKS:
+            content_checks.setdefault(filepath, []).append((required_strings, description))
+        
+        for index, (title, checks) in enumerate(self.SECTIONS):
+            if index:
+                print()
+            print(title)
+            for path, description in checks:
+                if path.endswith("/"):
+                    self.check_directory_exists(path.rstrip("/"), description)
+                    continue
+                self.check_file_exists(path, description)
+                for required_strings, content_description in content_checks.get(path, ()):
+                    self.check_file_content(path, required_strings, content_description)
         
         print()
         print("="*70)